@@ -535,6 +535,29 @@ def find_header(imgfile: str) -> str:
     raise IOError("No header found for file {0}".format(imgfile))
 
 
+def resample_matrix(wl: np.array, wl2: np.array, fwhm2: np.array) -> np.array:
+    """Build the matrix of Gaussian spectral response functions that maps a
+       spectrum sampled at one set of wavelengths onto another.  Row i is
+       equivalent to spectral_response_function(wl, wl2[i], fwhm2[i] / 2.355).
+
+    Args:
+        wl: sample starting wavelengths
+        wl2: wavelengths to resample to
+        fwhm2: full-width-half-max at resample resolution
+
+    Returns:
+        np.array: resampling matrix of size [len(wl2) x len(wl)]
+
+    """
+    sigma = np.abs(fwhm2 / 2.355)
+    u = (wl[np.newaxis, :] - wl2[:, np.newaxis]) / sigma[:, np.newaxis]
+    H = np.exp(-u * u / 2.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        H = H / H.sum(axis=1, keepdims=True)
+    H[np.isnan(H)] = 0
+    return H
+
+
 def resample_spectrum(
     x: np.array, wl: np.array, wl2: np.array, fwhm2: np.array, fill: bool = False
 ) -> np.array:
@@ -552,13 +575,7 @@ def resample_spectrum(
         np.array: interpolated radiance vector
 
     """
-    H = np.array(
-        [
-            spectral_response_function(wl, wi, fwhmi / 2.355)
-            for wi, fwhmi in zip(wl2, fwhm2)
-        ]
-    )
-    H[np.isnan(H)] = 0
+    H = resample_matrix(wl, wl2, fwhm2)
 
     dims = len(x.shape)
     if fill:
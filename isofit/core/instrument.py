@@ -19,11 +19,13 @@
 #
 
 import logging
+from functools import cached_property
 
 import numpy as np
 from scipy.interpolate import interp1d, splev, splrep
 from scipy.io import loadmat
-from scipy.signal import convolve
+from scipy.signal import convolve, oaconvolve
+from scipy.sparse import csr_matrix
 
 from isofit.configs import Config
 
@@ -31,7 +33,7 @@ from .common import (
     emissive_radiance,
     eps,
     load_wavelen,
-    resample_spectrum,
+    resample_matrix,
     spectral_response_function,
 )
 
@@ -40,6 +42,13 @@ from .common import (
 # Max. wavelength difference (nm) that does not trigger expensive resampling
 wl_tol = 0.01
 
+# Spectral response weights below this value are dropped from the sparse
+# resampling matrix
+srf_tol = 1e-6
+
+# Min. kernel length (taps) at which overlap-add beats direct convolution
+oaconvolve_min_taps = 128
+
 
 ### Classes ###
 
@@ -59,14 +68,28 @@ class Instrument:
 
         self.fast_resample = config.fast_resample
 
-        self.bounds = config.statevector.get_all_bounds()
-        self.scale = config.statevector.get_all_scales()
-        self.init = config.statevector.get_all_inits()
+        self.bounds = np.array(config.statevector.get_all_bounds())
+        self.scale = np.array(config.statevector.get_all_scales())
+        self.init = np.array(config.statevector.get_all_inits())
         self.prior_mean = np.array(config.statevector.get_all_prior_means())
         self.prior_sigma = np.array(config.statevector.get_all_prior_sigmas())
         self.statevec_names = config.statevector.get_element_names()
         self.n_state = len(self.statevec_names)
 
+        # State vector positions by name, and the (position, channel) pairs
+        # of any spline knots perturbing the FWHM or wavelength calibration
+        self._statevec_idx = {v: i for i, v in enumerate(self.statevec_names)}
+        self._fwhm_knots = [
+            (i, float(v.split("_")[1]))
+            for i, v in enumerate(self.statevec_names)
+            if v.startswith("FWHMSPL")
+        ]
+        self._wl_knots = [
+            (i, int(v.split("_")[1]))
+            for i, v in enumerate(self.statevec_names)
+            if v.startswith("WLSPL")
+        ]
+
         if config.SNR is not None:
             self.model_type = "SNR"
             self.snr = config.SNR
@@ -78,7 +101,9 @@ class Instrument:
                 interp1d(coeffs[:, 0], coeffs[:, col], fill_value="extrapolate")
                 for col in (1, 2, 3)
             ]
-            self.noise = np.array([[p_a(w), p_b(w), p_c(w)] for w in self.wl_init])
+            self.noise = np.stack(
+                [p_a(self.wl_init), p_b(self.wl_init), p_c(self.wl_init)], axis=1
+            )
             self.integrations = config.integrations
 
         elif config.pushbroom_noise_file is not None:
@@ -90,8 +115,11 @@ class Instrument:
                 logging.error("Noise model mismatches wavelength # bands")
                 raise ValueError("Noise model mismatches wavelength # bands")
             cshape = (self.ncols, self.n_chan, self.n_chan)
-            self.covs = D["covariances"].reshape(cshape)
+            # Only the column-averaged covariance is used, so the full stack
+            # is not kept after loading
+            self._cov_mean = np.squeeze(D["covariances"].reshape(cshape).mean(axis=0))
             self.integrations = config.integrations
+            self._cov_chol = None
 
         elif config.nedt_noise_file is not None:
             self.model_type = "NEDT"
@@ -111,11 +139,7 @@ class Instrument:
 
         # We track several unretrieved free variables, that are specified
         # in a fixed order (always start with relative radiometric
-        # calibration)
-        self.bvec = ["Cal_Relative_%04i" % int(w) for w in self.wl_init] + [
-            "Cal_Spectral",
-            "Cal_Stray_SRF",
-        ]
+        # calibration).  Their names are only built when requested, see bvec.
         self.bval = np.zeros(self.n_chan + 2)
 
         if config.unknowns is not None:
@@ -129,15 +153,13 @@ class Instrument:
                 u = np.loadtxt(f, comments="#")
                 if len(u.shape) > 0 and u.shape[1] > 1:
                     u = u[:, 1]
-                self.bval[: self.n_chan] = self.bval[: self.n_chan] + pow(u, 2)
+                self.bval[: self.n_chan] = self.bval[: self.n_chan] + u * u
 
             # Uncorrelated radiometric uncertainties are consistent and
             # independent in all channels.
             if config.unknowns.uncorrelated_radiometric_uncertainty is not None:
                 u = config.unknowns.uncorrelated_radiometric_uncertainty
-                self.bval[: self.n_chan] = self.bval[: self.n_chan] + pow(
-                    np.ones(self.n_chan) * u, 2
-                )
+                self.bval[: self.n_chan] = self.bval[: self.n_chan] + u * u
 
             # Radiometric uncertainties combine via Root Sum Square...
             # Be careful to avoid square roots of zero!
@@ -151,6 +173,9 @@ class Instrument:
             if config.unknowns.stray_srf_uncertainty is not None:
                 self.bval[-1] = config.unknowns.stray_srf_uncertainty
 
+        # Fixed blur kernel used to model spectral stray light
+        self._stray_srf = spectral_response_function(np.arange(-10, 11), 0, 4)
+
         # Determine whether the calibration is fixed.  If it is fixed,
         # and the wavelengths of radiative transfer modeling and instrument
         # are the same, then we can bypass computationally expensive sampling
@@ -163,6 +188,22 @@ class Instrument:
         ):
             self.calibration_fixed = False
 
+        # Sparse resampling matrix for a fixed calibration, stored with the
+        # wavelength grids it was built for
+        self._srf_cache = None
+
+        # Whether the most recent high resolution grid matches wl_init
+        self._wl_match_cache = None
+
+    @cached_property
+    def bvec(self):
+        """Names of the unretrieved instrument parameters, in the order of bval."""
+
+        return ["Cal_Relative_%04i" % w for w in self.wl_init.astype(int)] + [
+            "Cal_Spectral",
+            "Cal_Stray_SRF",
+        ]
+
     def xa(self):
         """Mean of prior distribution, calculated at state x."""
 
@@ -173,26 +214,39 @@ class Instrument:
 
         if self.n_state == 0:
             return np.zeros((0, 0), dtype=float)
-        return np.diagflat(np.power(self.prior_sigma, 2))
+        return np.diagflat(self.prior_sigma * self.prior_sigma)
 
     def Sy(self, meas, geom):
-        """Calculate measuremment error covariance.  Kelvin Man Yiu Leung and
-            Jayanth Jagalur Mohan (MIT) developed the noise clipping strategy.
+        """Calculate measuremment error covariance.
 
         Input: meas, the instrument measurement
         Returns: Sy, the measurement error covariance due to instrument noise
         """
+        if self.model_type == "pushbroom":
+            # Note the covariance is divided by sqrt(integrations), whereas
+            # the parametric model's variance scales with 1/integrations
+            return self._cov_mean / np.sqrt(self.integrations)
+
+        return np.diag(self.Sy_diagonal(meas, geom))
+
+    def Sy_diagonal(self, meas, geom):
+        """Calculate the diagonal of the measurement error covariance, i.e.
+            the noise variance of each channel.  Kelvin Man Yiu Leung and
+            Jayanth Jagalur Mohan (MIT) developed the noise clipping strategy.
+
+        Input: meas, the instrument measurement
+        Returns: a vector of size n_chan with the noise variance per channel
+        """
         if self.model_type == "SNR":
             nedl = (1.0 / self.snr) * meas
             minimum_noise = np.sqrt(1e-7)
-            bad = nedl < minimum_noise
-            if np.any(bad):
+            if nedl.min() < minimum_noise:
                 logging.debug(
                     "SNR noise model found noise <= 0 - adjusting to slightly positive"
                     " to avoid /0."
                 )
-            nedl[bad] = minimum_noise
-            return np.diagflat(np.power(nedl, 2))
+            np.maximum(nedl, minimum_noise, out=nedl)
+            return nedl * nedl
 
         elif self.model_type == "parametric":
             noise_plus_meas = self.noise[:, 1] + meas
@@ -202,35 +256,81 @@ class Instrument:
                     "Parametric noise model found noise <= 0 - adjusting to slightly"
                     " positive to avoid /0."
                 )
-            nedl = np.abs(
-                self.noise[:, 0] * np.sqrt(noise_plus_meas) + self.noise[:, 2]
-            )
-            nedl = nedl / np.sqrt(self.integrations)
-            return np.diagflat(np.power(nedl, 2))
+            # Evaluate |A * sqrt(B + meas) + C| / sqrt(integrations) in place
+            nedl = np.sqrt(noise_plus_meas, out=noise_plus_meas)
+            nedl *= self.noise[:, 0]
+            nedl += self.noise[:, 2]
+            np.abs(nedl, out=nedl)
+            nedl /= np.sqrt(self.integrations)
+            return np.square(nedl, out=nedl)
 
         elif self.model_type == "pushbroom":
-            C = np.squeeze(self.covs.mean(axis=0))
-            return C / np.sqrt(self.integrations)
+            return np.diag(self.Sy(meas, geom)).copy()
 
         elif self.model_type == "NEDT":
-            return np.diagflat(np.power(self.noise_NESR, 2))
+            return self.noise_NESR * self.noise_NESR
 
     def dmeas_dinstrument(self, x_instrument, wl_hi, rdn_hi):
         """Jacobian of measurement with respect to the instrument
-        free parameter state vector. We use finite differences for now."""
+        free parameter state vector. Wavelength shift, wavelength spacing
+        and FWHM growth are differentiated analytically through the Gaussian
+        spectral response; other parameters use finite differences."""
 
         dmeas_dinstrument = np.zeros((self.n_chan, self.n_state), dtype=float)
         if self.n_state == 0:
             return dmeas_dinstrument
 
-        meas = self.sample(x_instrument, wl_hi, rdn_hi)
-        for ind in range(self.n_state):
-            x_instrument_perturb = x_instrument.copy()
-            x_instrument_perturb[ind] = x_instrument_perturb[ind] + eps
-            meas_perturb = self.sample(x_instrument_perturb, wl_hi, rdn_hi)
-            dmeas_dinstrument[:, ind] = (meas_perturb - meas) / eps
+        idx = self._statevec_idx
+        analytic = [v for v in ("WL_SHIFT", "WL_SPACE", "GROW_FWHM") if v in idx]
+        if analytic:
+            dmeas_dwl, dmeas_dfwhm = self.dmeas_dcalibration(
+                x_instrument, wl_hi, rdn_hi
+            )
+            if "WL_SHIFT" in idx:
+                dmeas_dinstrument[:, idx["WL_SHIFT"]] = dmeas_dwl
+            if "WL_SPACE" in idx:
+                space_orig = self.wl_init - self.wl_init[0]
+                dmeas_dinstrument[:, idx["WL_SPACE"]] = dmeas_dwl * space_orig
+            if "GROW_FWHM" in idx:
+                dmeas_dinstrument[:, idx["GROW_FWHM"]] = dmeas_dfwhm
+
+        # Each perturbation shifts the calibration, so every column needs its
+        # own resampling matrix; the unperturbed measurement is shared.
+        numeric = [i for v, i in idx.items() if v not in analytic]
+        if numeric:
+            meas = self.sample(x_instrument, wl_hi, rdn_hi)
+            x_perturb = x_instrument + np.eye(self.n_state) * eps
+            for ind in numeric:
+                meas_perturb = self.sample(x_perturb[ind], wl_hi, rdn_hi)
+                dmeas_dinstrument[:, ind] = (meas_perturb - meas) / eps
         return dmeas_dinstrument
 
+    def dmeas_dcalibration(self, x_instrument, wl_hi, rdn_hi):
+        """Derivatives of each channel's measurement with respect to its own
+        center wavelength and FWHM. Each row of the resampling matrix is a
+        normalized Gaussian H_ij = g_ij / sum_k g_ik, so for any parameter p
+        of channel i, dH_ij/dp = H_ij * (dlog g_ij/dp - sum_k H_ik dlog g_ik/dp).
+
+        Returns: two vectors of size n_chan, d(meas)/d(wl) and d(meas)/d(fwhm)
+        """
+
+        wl, fwhm = self.calibration(x_instrument)
+        H = resample_matrix(wl_hi, wl, fwhm)
+        if np.isnan(rdn_hi).any():
+            rdn_hi = np.where(np.isnan(rdn_hi), 0, rdn_hi)
+
+        # With u = (wl_hi - wl) / sigma, the log-derivatives of the Gaussian
+        # are u / sigma for the center and u * u / sigma for the width
+        sigma = np.abs(fwhm) / 2.355
+        u = (wl_hi[np.newaxis, :] - wl[:, np.newaxis]) / sigma[:, np.newaxis]
+        Hu = H * u
+        Huu = Hu * u
+
+        meas = H @ rdn_hi
+        dmeas_dwl = (Hu @ rdn_hi - meas * Hu.sum(axis=1)) / sigma
+        dmeas_dsigma = (Huu @ rdn_hi - meas * Huu.sum(axis=1)) / sigma
+        return dmeas_dwl, dmeas_dsigma / 2.355
+
     def dmeas_dinstrumentb(self, x_instrument, wl_hi, rdn_hi):
         """Jacobian of radiance with respect to the instrument parameters
         that are unknown and not retrieved, i.e., the inevitable persisting
@@ -242,7 +342,8 @@ class Instrument:
 
         # Uncertainty due to radiometric calibration
         meas = self.sample(x_instrument, wl_hi, rdn_hi)
-        dmeas_dinstrument = np.hstack((np.diagflat(meas), np.zeros((self.n_chan, 2))))
+        dmeas_dinstrument = np.zeros((self.n_chan, self.n_chan + 2), dtype=float)
+        np.fill_diagonal(dmeas_dinstrument, meas)
 
         # Uncertainty due to spectral calibration
         if self.bval[-2] > 1e-6:
@@ -252,8 +353,7 @@ class Instrument:
 
         # Uncertainty due to spectral stray light
         if self.bval[-1] > 1e-6:
-            ssrf = spectral_response_function(np.arange(-10, 11), 0, 4)
-            blur = convolve(meas, ssrf, mode="same")
+            blur = convolve_same(meas, self._stray_srf)
             dmeas_dinstrument[:, -1] = blur - meas
 
         return dmeas_dinstrument
@@ -261,79 +361,141 @@ class Instrument:
     def sample(self, x_instrument, wl_hi, rdn_hi):
         """Apply instrument sampling to a radiance spectrum, returning predicted measurement."""
 
-        if (
-            self.calibration_fixed
-            and (len(self.wl_init) == len(wl_hi))
-            and all((self.wl_init - wl_hi) < wl_tol)
-        ):
+        if self.calibration_fixed and self.matches_wl_init(wl_hi):
             return rdn_hi
         wl, fwhm = self.calibration(x_instrument)
+
+        # The "fast resample" option approximates a complete resampling
+        # by a convolution with a uniform FWHM.
+        # All rows share one kernel, so the blur and interpolation are each
+        # done in a single call over the whole array.
+        if rdn_hi.ndim > 1 and self.fast_resample:
+            ssrf = spectral_response_function(np.arange(-10, 11), 0, fwhm[0])
+            blur = convolve_same(rdn_hi, ssrf)
+            return interp1d(wl_hi, blur, axis=1)(wl)
+
+        # Replace NaNs with zeros
+        if np.isnan(rdn_hi).any():
+            rdn_hi = np.where(np.isnan(rdn_hi), 0, rdn_hi)
+
+        H = self._srf_matrix(wl_hi, wl, fwhm)
         if rdn_hi.ndim == 1:
-            return resample_spectrum(rdn_hi, wl_hi, wl, fwhm)
+            return H @ rdn_hi
         else:
-            resamp = []
-            # The "fast resample" option approximates a complete resampling
-            # by a convolution with a uniform FWHM.
-            if self.fast_resample:
-                for i, r in enumerate(rdn_hi):
-                    ssrf = spectral_response_function(np.arange(-10, 11), 0, fwhm[0])
-                    blur = convolve(r, ssrf, mode="same")
-                    resamp.append(interp1d(wl_hi, blur)(wl))
-            else:
-                for i, r in enumerate(rdn_hi):
-                    r2 = resample_spectrum(r, wl_hi, wl, fwhm)
-                    resamp.append(r2)
-            return np.array(resamp)
+            return (H @ rdn_hi.T).T
+
+    def matches_wl_init(self, wl_hi):
+        """Check whether a wavelength grid coincides with the instrument
+        channels to within wl_tol. The result is cached for the most recent
+        grid object, which is normally the radiative transfer wavelengths."""
+
+        cache = self._wl_match_cache
+        if cache is not None and cache[0] is wl_hi:
+            return cache[1]
+
+        match = len(self.wl_init) == len(wl_hi) and bool(
+            np.all(np.abs(self.wl_init - wl_hi) < wl_tol)
+        )
+        self._wl_match_cache = (wl_hi, match)
+        return match
+
+    def _srf_matrix(self, wl_hi, wl, fwhm):
+        """Matrix of spectral response functions that maps a radiance
+        spectrum at wl_hi onto channel centers wl with widths fwhm. When the
+        calibration is fixed the matrix never changes, so its far tails are
+        dropped and it is cached in sparse form against the high resolution
+        grid. A variable calibration gets the dense, untruncated matrix so
+        that sampling stays smooth in the calibration parameters."""
+
+        fixed = self.calibration_fixed and not (self._wl_knots or self._fwhm_knots)
+        if not fixed:
+            return resample_matrix(wl_hi, wl, fwhm)
+
+        cache = self._srf_cache
+        if (
+            cache is not None
+            and np.array_equal(cache[0], wl_hi)
+            and np.array_equal(cache[1], wl)
+            and np.array_equal(cache[2], fwhm)
+        ):
+            return cache[3]
+
+        # Drop the far tails of each response and renormalize the rows
+        H = resample_matrix(wl_hi, wl, fwhm)
+        H[H < srf_tol] = 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            H = H / H.sum(axis=1, keepdims=True)
+        H[np.isnan(H)] = 0
+        H = csr_matrix(H)
+
+        self._srf_cache = (wl_hi.copy(), wl.copy(), fwhm.copy(), H)
+        return H
 
     def simulate_measurement(self, meas, geom):
         """Simulate a measurement by the given sensor, for a true radiance
         sampled to instrument wavelengths. This basically just means
         drawing a sample from the noise distribution."""
 
-        Sy = self.Sy(meas, geom)
-        mu = np.zeros(meas.shape)
-        rdn_sim = meas + np.random.multivariate_normal(mu, Sy)
+        if self.model_type == "pushbroom":
+            # The pushbroom covariance does not depend on the measurement, so
+            # its Cholesky factor is computed once and reused.  Sy divides
+            # the covariance by sqrt(integrations), which is applied to the
+            # draw at call time since callers may change integrations.
+            if self._cov_chol is None:
+                C = self._cov_mean.astype(np.float32)
+                jitter = np.finfo(np.float32).eps * np.abs(np.diag(C)).max()
+                C[np.diag_indices_from(C)] += jitter
+                self._cov_chol = np.linalg.cholesky(C)
+            noise = np.random.standard_normal(meas.shape) @ self._cov_chol.T
+            noise *= self.integrations**-0.25
+        else:
+            # Channels are independent, so scale unit normals by the noise
+            noise = np.random.standard_normal(meas.shape) * np.sqrt(
+                self.Sy_diagonal(meas, geom)
+            )
+        rdn_sim = meas + noise
         return rdn_sim
 
+    def simulate_batch(self, meas):
+        """Simulate measurements for a batch of true radiances, one spectrum
+        per row of meas, drawing the noise for every spectrum in a single
+        vectorized call. The instrument noise models depend only on the
+        radiance, not on observation geometry, so no geometry is taken; a
+        geometry-dependent model would need simulate_measurement per pixel.
+
+        Input: meas, an array of size [n_spectra x n_chan]
+        Returns: simulated measurements, an array of size [n_spectra x n_chan]
+        """
+
+        return self.simulate_measurement(np.atleast_2d(meas), None)
+
     def calibration(self, x_instrument):
         """Calculate the measured wavelengths."""
 
         wl, fwhm = self.wl_init, self.fwhm_init
         space_orig = wl - wl[0]
         offset = wl[0]
-        if "GROW_FWHM" in self.statevec_names:
-            ind = self.statevec_names.index("GROW_FWHM")
-            fwhm = fwhm + x_instrument[ind]
-        elif any([v.startswith("FWHMSPL") for v in self.statevec_names]):
+        idx = self._statevec_idx
+        if "GROW_FWHM" in idx:
+            fwhm = fwhm + x_instrument[idx["GROW_FWHM"]]
+        elif self._fwhm_knots:
             # cubic spline perturbation
-            channels, vals = [], []
-            for i, v in enumerate(self.statevec_names):
-                if v.startswith("FWHMSPL"):
-                    chan = float(v.split("_")[1])
-                    channels.append(chan)
-                    vals.append(x_instrument[i])
-            sp = splrep(channels, vals, s=0)
+            inds, channels = zip(*self._fwhm_knots)
+            sp = splrep(channels, [x_instrument[i] for i in inds], s=0)
             xnew = np.arange(len(wl))
             fwhm = fwhm + splev(xnew, sp)
 
-        if "WL_SPACE" in self.statevec_names:
-            ind = self.statevec_names.index("WL_SPACE")
-            space = x_instrument[ind]
+        if "WL_SPACE" in idx:
+            space = x_instrument[idx["WL_SPACE"]]
         else:
             space = 1.0
 
-        if "WL_SHIFT" in self.statevec_names:
-            ind = self.statevec_names.index("WL_SHIFT")
-            shift = x_instrument[ind]
-        elif any([v.startswith("WLSPL") for v in self.statevec_names]):
+        if "WL_SHIFT" in idx:
+            shift = x_instrument[idx["WL_SHIFT"]]
+        elif self._wl_knots:
             # cubic spline perturbation
-            channels, vals = [], []
-            for i, v in enumerate(self.statevec_names):
-                if v.startswith("WLSPL"):
-                    chan = int(v.split("_")[1])
-                    channels.append(chan)
-                    vals.append(x_instrument[i])
-            sp = splrep(channels, vals, s=0)
+            inds, channels = zip(*self._wl_knots)
+            sp = splrep(channels, [x_instrument[i] for i in inds], s=0)
             xnew = np.arange(len(wl))
             shift = splev(xnew, sp)
         else:
@@ -348,3 +510,27 @@ class Instrument:
         if len(x_instrument) < 1:
             return ""
         return "Instrument: " + " ".join(["%5.3f" % xi for xi in x_instrument])
+
+
+def convolve_same(x, kernel):
+    """Convolve a spectrum, or each row of an array of spectra, with a 1-D
+    kernel and return the central part with the same size as x. Short
+    kernels are applied directly; overlap-add only pays off for long ones.
+
+    Args:
+        x: spectrum, or array of spectra with one spectrum per row
+        kernel: 1-D convolution kernel
+
+    Returns:
+        np.array: convolved spectra, same shape as x
+    """
+
+    if len(kernel) >= oaconvolve_min_taps:
+        kernel = kernel.reshape((1,) * (x.ndim - 1) + (-1,))
+        return oaconvolve(x, kernel, mode="same", axes=-1)
+    # np.convolve returns max(len(x), len(kernel)) samples, so it is only
+    # used when the spectrum is at least as long as the kernel
+    if x.ndim == 1 and len(x) >= len(kernel):
+        return np.convolve(x, kernel, mode="same")
+    kernel = kernel.reshape((1,) * (x.ndim - 1) + (-1,))
+    return convolve(x, kernel, mode="same", method="direct")
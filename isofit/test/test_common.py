@@ -12,6 +12,7 @@ from isofit.core.common import (
     load_spectrum,
     load_wavelen,
     recursive_replace,
+    resample_matrix,
     spectral_response_function,
     svd_inv,
     svd_inv_sqrt,
@@ -51,6 +52,17 @@ def test_expand_path():  # -- backslash vs forward slash discrepancy
     assert expand_path("NASA", "/JPL") == "/JPL"
 
 
+def test_resample_matrix():
+    wl = np.arange(400.0, 500.0, 0.5)
+    wl2 = np.array([420.0, 450.5, 480.25])
+    fwhm2 = np.array([5.0, 7.5, 10.0])
+    H = resample_matrix(wl, wl2, fwhm2)
+    assert H.shape == (3, len(wl))
+    for row, wi, fwhmi in zip(H, wl2, fwhm2):
+        srf = spectral_response_function(wl, wi, fwhmi / 2.355)
+        assert np.allclose(row, srf, rtol=1e-12, atol=1e-15)
+
+
 def test_spectral_response_function():
     response_range = np.array([10, 8])
     mu = 6.0
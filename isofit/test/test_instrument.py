@@ -1,5 +1,208 @@
-from isofit.core.instrument import wl_tol
+import numpy as np
+from scipy.io import savemat
+from scipy.signal import convolve
+
+from isofit.configs import Config
+from isofit.core.common import resample_spectrum
+from isofit.core.instrument import (
+    Instrument,
+    convolve_same,
+    oaconvolve_min_taps,
+    wl_tol,
+)
+
+
+def build_instrument(tmp_path, n_chan=60, **instrument_config):
+    """Instrument with evenly spaced channels from 400 nm, 5 nm apart."""
+    wl = 400.0 + 5.0 * np.arange(n_chan)
+    wavelength_file = tmp_path / "wavelengths.txt"
+    np.savetxt(wavelength_file, np.c_[np.arange(n_chan), wl, np.full(n_chan, 6.0)])
+    config = {"wavelength_file": str(wavelength_file), "integrations": 1}
+    config.update(instrument_config)
+    return Instrument(Config({"forward_model": {"instrument": config}}))
+
+
+def write_pushbroom_noise(tmp_path, n_chan, n_cols=3):
+    """Random positive definite covariances, one per cross-track column."""
+    A = np.random.standard_normal((n_cols, n_chan, n_chan))
+    covs = A @ A.transpose(0, 2, 1) / n_chan + 0.1 * np.eye(n_chan)
+    noise_file = tmp_path / "pushbroom.mat"
+    savemat(
+        noise_file,
+        {
+            "columns": np.array([[n_cols]]),
+            "bands": np.array([[n_chan * n_chan]]),
+            "covariances": covs.reshape(n_cols, -1),
+        },
+    )
+    return noise_file, covs
 
 
 def test_wl_tol():
     assert wl_tol == 0.01
+
+
+def test_convolve_same():
+    rng = np.random.default_rng(0)
+    for n in (500, 9):
+        x = rng.random((3, n))
+        for taps in (21, oaconvolve_min_taps + 1):
+            kernel = rng.random(taps)
+            expected = convolve(x, kernel[np.newaxis, :], mode="same")
+            assert convolve_same(x, kernel).shape == x.shape
+            assert convolve_same(x[0], kernel).shape == x[0].shape
+            assert np.allclose(convolve_same(x, kernel), expected)
+            assert np.allclose(convolve_same(x[0], kernel), expected[0])
+
+
+def test_matches_wl_init(tmp_path):
+    instrument = build_instrument(tmp_path, SNR=100)
+    wl = instrument.wl_init
+    assert instrument.matches_wl_init(wl)
+    assert instrument.matches_wl_init(wl + 0.5 * wl_tol)
+    assert instrument.matches_wl_init(wl - 0.5 * wl_tol)
+    assert not instrument.matches_wl_init(wl + 2 * wl_tol)
+    assert not instrument.matches_wl_init(wl - 2 * wl_tol)
+    assert not instrument.matches_wl_init(wl[:-1])
+
+    # A shifted grid is resampled rather than passed through
+    rdn = np.linspace(1.0, 2.0, len(wl))
+    assert instrument.sample(np.array([]), wl, rdn) is rdn
+    assert instrument.sample(np.array([]), wl + 2 * wl_tol, rdn) is not rdn
+
+
+def test_simulate_batch(tmp_path):
+    np.random.seed(0)
+    instrument = build_instrument(tmp_path, SNR=50)
+    meas = np.tile(np.linspace(1.0, 20.0, instrument.n_chan), (20000, 1))
+    sims = instrument.simulate_batch(meas)
+    assert sims.shape == meas.shape
+
+    # Each channel's sample variance matches its noise model variance
+    variance = (sims - meas).var(axis=0)
+    expected = instrument.Sy_diagonal(meas[0].copy(), None)
+    assert np.allclose(variance / expected, 1.0, atol=0.05)
+
+
+def test_dmeas_dinstrument_analytic(tmp_path):
+    element = {"bounds": [-5, 5], "scale": 1, "prior_mean": 0, "prior_sigma": 1}
+    statevector = {
+        "GROW_FWHM": dict(element, init=0.0),
+        "WL_SHIFT": dict(element, init=0.0),
+        "WL_SPACE": dict(element, bounds=[0.9, 1.1], init=1.0, prior_mean=1.0),
+    }
+    instrument = build_instrument(
+        tmp_path, SNR=100, statevector=statevector, fast_resample=False
+    )
+    wl_hi = np.arange(370.0, 730.0, 0.5)
+    rdn_hi = 10 + 5 * np.sin(wl_hi / 30.0) + np.cos(wl_hi / 7.0)
+    x = np.array([0.3, 0.1, 1.001])
+    K = instrument.dmeas_dinstrument(x, wl_hi, rdn_hi)
+
+    # Central differences through the dense, untruncated resampling
+    h = 1e-4
+    for ind in range(len(x)):
+        x_plus, x_minus = x.copy(), x.copy()
+        x_plus[ind] += h
+        x_minus[ind] -= h
+        meas_plus = resample_spectrum(
+            rdn_hi.copy(), wl_hi, *instrument.calibration(x_plus)
+        )
+        meas_minus = resample_spectrum(
+            rdn_hi.copy(), wl_hi, *instrument.calibration(x_minus)
+        )
+        fd = (meas_plus - meas_minus) / (2 * h)
+        assert np.abs(K[:, ind] - fd).max() < 1e-5 * np.abs(fd).max()
+
+
+def test_sample_matches_resample_spectrum(tmp_path):
+    wl_hi = np.arange(370.0, 730.0, 0.5)
+    rdn_hi = 10 + 5 * np.sin(wl_hi / 30.0) + np.cos(wl_hi / 7.0)
+    rdn_hi_2d = np.outer([0.5, 1.0, 2.0], rdn_hi)
+
+    # Fixed calibration: cached sparse matrix with truncated tails
+    instrument = build_instrument(tmp_path, SNR=100, fast_resample=False)
+    x = np.array([])
+    wl, fwhm = instrument.calibration(x)
+    expected = resample_spectrum(rdn_hi.copy(), wl_hi, wl, fwhm)
+    scale = np.abs(expected).max()
+    for _ in range(2):  # build, then reuse the cached matrix
+        sampled = instrument.sample(x, wl_hi, rdn_hi)
+        assert np.abs(sampled - expected).max() < 1e-5 * scale
+    expected_2d = resample_spectrum(rdn_hi_2d.copy(), wl_hi, wl, fwhm)
+    sampled_2d = instrument.sample(x, wl_hi, rdn_hi_2d)
+    assert np.abs(sampled_2d - expected_2d).max() < 1e-5 * np.abs(expected_2d).max()
+
+    # Variable calibration: dense matrix, identical to the reference
+    element = {"bounds": [-5, 5], "scale": 1, "prior_mean": 0, "prior_sigma": 1}
+    instrument = build_instrument(
+        tmp_path,
+        SNR=100,
+        statevector={"WL_SHIFT": dict(element, init=0.0)},
+        fast_resample=False,
+    )
+    x = np.array([0.3])
+    wl, fwhm = instrument.calibration(x)
+    expected = resample_spectrum(rdn_hi.copy(), wl_hi, wl, fwhm)
+    assert np.allclose(instrument.sample(x, wl_hi, rdn_hi), expected)
+    expected_2d = resample_spectrum(rdn_hi_2d.copy(), wl_hi, wl, fwhm)
+    assert np.allclose(instrument.sample(x, wl_hi, rdn_hi_2d), expected_2d)
+
+
+def test_noise_integrations_set_after_construction(tmp_path):
+    # Callers such as the empirical line reset integrations after loading
+    noise_file = tmp_path / "noise.txt"
+    np.savetxt(noise_file, [[350.0, 0.1, 2.0, 0.01], [2600.0, 0.1, 2.0, 0.01]])
+    instrument = build_instrument(
+        tmp_path, parametric_noise_file=str(noise_file), integrations=100
+    )
+    meas = np.full(instrument.n_chan, 10.0)
+    variance_100 = instrument.Sy_diagonal(meas.copy(), None)
+    instrument.integrations = 1
+    variance_1 = instrument.Sy_diagonal(meas.copy(), None)
+    assert np.allclose(variance_1, 100 * variance_100)
+    assert np.allclose(variance_1, (0.1 * np.sqrt(12.0) + 0.01) ** 2)
+
+
+def test_pushbroom_noise(tmp_path):
+    np.random.seed(0)
+    n_chan = 20
+    noise_file, covs = write_pushbroom_noise(tmp_path, n_chan)
+    instrument = build_instrument(
+        tmp_path,
+        n_chan=n_chan,
+        pushbroom_noise_file=str(noise_file),
+        integrations=100,
+    )
+    meas = np.ones((20000, n_chan))
+    for integrations in (100, 1):
+        instrument.integrations = integrations
+        Sy = instrument.Sy(meas[0], None)
+        assert np.allclose(Sy, covs.mean(axis=0) / np.sqrt(integrations))
+        sims = instrument.simulate_batch(meas)
+        assert sims.shape == meas.shape
+        assert np.allclose(np.cov((sims - meas).T), Sy, atol=0.05 * Sy.max())
+
+
+def test_Sy_diagonal_matches_Sy(tmp_path):
+    np.random.seed(0)
+    parametric_file = tmp_path / "parametric.txt"
+    np.savetxt(parametric_file, [[350.0, 0.1, 2.0, 0.01], [2600.0, 0.1, 2.0, 0.01]])
+    nedt_file = tmp_path / "nedt.csv"
+    np.savetxt(nedt_file, [[0.3, 0.2], [1.0, 0.3]], delimiter=",", header="\n" * 7)
+    pushbroom_file, _ = write_pushbroom_noise(tmp_path, 60)
+    noise_models = [
+        {"SNR": 100},
+        {"parametric_noise_file": str(parametric_file), "integrations": 4},
+        {"nedt_noise_file": str(nedt_file)},
+        {"pushbroom_noise_file": str(pushbroom_file), "integrations": 4},
+    ]
+    for noise_model in noise_models:
+        instrument = build_instrument(tmp_path, **noise_model)
+        meas = np.linspace(1.0, 20.0, instrument.n_chan)
+        Sy = instrument.Sy(meas.copy(), None)
+        Sy_diagonal = instrument.Sy_diagonal(meas.copy(), None)
+        assert Sy.shape == (instrument.n_chan, instrument.n_chan)
+        assert np.allclose(np.diag(Sy), Sy_diagonal)
+        if instrument.model_type != "pushbroom":
+            assert np.allclose(Sy, np.diag(Sy_diagonal))
@@ -305,10 +305,10 @@ def _run_chunk(
                     np.multiply(bmarg.T, A).sum(axis=0)
                 )
             else:
-                Sy = instrument.Sy(x, geom=None)
+                Sy_diag = instrument.Sy_diagonal(x, geom=None)
                 calunc = instrument.bval[: instrument.n_chan]
                 output_uncertainty_row[col, :] = (
-                    np.sqrt(np.diag(Sy) + pow(calunc * x, 2)) * bhat[:, 1]
+                    np.sqrt(Sy_diag + np.square(calunc * x)) * bhat[:, 1]
                 )
 
             nspectra = nspectra + 1
@@ -20,8 +20,6 @@
 
 from os.path import abspath, split
 
-import numpy as np
-
 from isofit.core.common import expand_path, json_load_ascii, load_spectrum
 from isofit.core.geometry import Geometry
 from isofit.core.instrument import Instrument
@@ -40,8 +38,7 @@ def generate_noise(config):
 
     if infile.endswith("txt"):
         rdn, wl = load_spectrum(infile)
-        Sy = instrument.Sy(rdn, geom)
-        rdn_noise = rdn + np.random.multivariate_normal(np.zeros(rdn.shape), Sy)
+        rdn_noise = instrument.simulate_measurement(rdn, geom)
         with open(outfile, "w") as fout:
             for w, r in zip(wl, rdn_noise):
                 fout.write("%8.5f %8.5f" % (w, r))